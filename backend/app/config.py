@@ -1,5 +1,4 @@
 from pydantic_settings import BaseSettings
-from functools import lru_cache
 
 
 class Settings(BaseSettings):
@@ -12,14 +11,25 @@ class Settings(BaseSettings):
     composio_api_key: str = ""
     composio_auth_config_id: str = ""
     composio_auth_config_id_google_drive: str = ""
+    # Seconds a user's Drive file listing is served from memory
+    composio_file_cache_ttl: int = 300
+    # Optional Redis shared by all workers for the Drive listing cache (needs `redis`)
+    redis_url: str = ""
     render_db_url: str = ""
+    pg_pool_min_size: int = 2
+    pg_pool_max_size: int = 10
     frontend_url: str = "http://localhost:3000"
+    # Extra origins allowed by CORS besides frontend_url (JSON list in env);
+    # defaults to the Vite dev server
+    cors_origins: list[str] = ["http://localhost:8080"]
 
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
 
 
-@lru_cache
+settings = Settings()
+
+
 def get_settings() -> Settings:
-    return Settings()
+    return settings
@@ -0,0 +1,49 @@
+from functools import lru_cache
+from typing import Annotated
+
+from fastapi import Depends
+
+from app.config import settings
+from app.services.composio import ComposioService
+from app.services.gemini import GeminiService
+from app.services.postgres import PostgresService
+
+
+@lru_cache
+def composio_service() -> ComposioService:
+    """Shared ComposioService built once from settings."""
+    return ComposioService(
+        api_key=settings.composio_api_key,
+        auth_config_id=settings.composio_auth_config_id,
+        drive_auth_config_id=settings.composio_auth_config_id_google_drive,
+        file_cache_ttl=settings.composio_file_cache_ttl,
+        redis_url=settings.redis_url,
+    )
+
+
+@lru_cache
+def gemini_service() -> GeminiService:
+    """Shared GeminiService built once from settings."""
+    return GeminiService(
+        api_key=settings.gemini_api_key,
+        project_id=settings.gcp_project_id,
+        location=settings.gcp_location,
+        use_vertex_ai=settings.use_vertex_ai
+    )
+
+
+@lru_cache
+def postgres_service() -> PostgresService:
+    """Shared PostgresService built once from settings."""
+    return PostgresService(
+        db_url=settings.render_db_url,
+        min_connections=settings.pg_pool_min_size,
+        max_connections=settings.pg_pool_max_size,
+    )
+
+
+# FastAPI resolves each dependency once per request, so every consumer in the
+# same request shares the instance
+ComposioDep = Annotated[ComposioService, Depends(composio_service)]
+GeminiDep = Annotated[GeminiService, Depends(gemini_service)]
+PostgresDep = Annotated[PostgresService, Depends(postgres_service)]
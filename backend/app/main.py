@@ -1,45 +1,88 @@
 from fastapi import FastAPI, HTTPException, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, TypeAdapter, field_validator
+from pydantic_core import to_json
+from cachetools import TTLCache
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+import asyncio
+import json
 import logging
+import logging.handlers
+import queue
+
+# Configure logging to show debug output. Records go through a queue so the
+# stream write happens on the listener thread, not in request handlers.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter('%(levelname)s - %(name)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
+
+logger = logging.getLogger(__name__)
+
+from app.config import settings
+from app.deps import ComposioDep, GeminiDep, PostgresDep, postgres_service
+from app.services.composio import ComposioService
+from app.services.gemini import GeminiService
+from app.services.postgres import PostgresService
+
+
+# Threads available to asyncio.to_thread for SDK and database calls
+BLOCKING_IO_THREADS = 32
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _log_listener.start()
+    # Composio, Gemini and psycopg2 are all blocking and run through
+    # asyncio.to_thread; the stock executor (cpu_count + 4 threads) is too small
+    # once several users' downloads and inserts overlap
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_IO_THREADS, thread_name_prefix="blocking-io")
+    )
+    yield
+    # Release pooled database connections on shutdown
+    postgres_service().close()
+    _log_listener.stop()
 
-# Configure logging to show debug output
-logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(name)s - %(message)s')
-
-from app.config import get_settings
 
 app = FastAPI(
     title="Spreadsheet Migration API",
     description="Migrate spreadsheets from Google Drive to Postgres databases",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[settings.frontend_url, *settings.cors_origins],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=600,
 )
 
+# Previews, query rows and migration logs are large, highly compressible text.
+# Level 5 gets most of the ratio of 9 at a fraction of the CPU.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+
+# Cap on concurrent Drive downloads / table inserts within one request
+MAX_CONCURRENT_TRANSFERS = 8
+
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
 
-def get_composio_service():
-    """Helper to create ComposioService with settings."""
-    from app.services.composio import ComposioService
-    settings = get_settings()
-    return ComposioService(
-        api_key=settings.composio_api_key,
-        auth_config_id=settings.composio_auth_config_id,
-        drive_auth_config_id=settings.composio_auth_config_id_google_drive,
-    )
-
-
 # =============================================================================
 # Composio OAuth Endpoints (matches frontend expectations)
 # =============================================================================
@@ -55,11 +98,17 @@ class ConnectResponse(BaseModel):
 
 
 @app.post("/api/composio/connect/google", response_model=ConnectResponse)
-async def connect_google(request: ConnectRequest, x_user_id: str = Header(default="default")):
+async def connect_google(
+    request: ConnectRequest,
+    service: ComposioDep,
+    x_user_id: str = Header(default="default"),
+):
     """Initiate Google Drive OAuth connection."""
-    service = get_composio_service()
-    settings = get_settings()
-    redirect_url = service.get_auth_url(x_user_id, request.redirectUrl or settings.frontend_url, use_drive=True)
+    service.invalidate(x_user_id)
+    _connections_cache.pop(x_user_id, None)
+    redirect_url = await asyncio.to_thread(
+        service.get_auth_url, x_user_id, request.redirectUrl or settings.frontend_url, use_drive=True
+    )
     return ConnectResponse(
         redirectUrl=redirect_url,
         connectionId=f"conn_{x_user_id}",
@@ -81,12 +130,12 @@ class ConnectionStatusResponse(BaseModel):
 
 @app.get("/api/composio/status", response_model=ConnectionStatusResponse)
 async def composio_status(
+    service: ComposioDep,
     provider: str = Query(default="google-drive"),
-    x_user_id: str = Header(default="default")
+    x_user_id: str = Header(default="default"),
 ):
     """Check connection status for a provider."""
-    service = get_composio_service()
-    connected = service.is_connected(x_user_id)
+    connected = await asyncio.to_thread(service.is_connected, x_user_id)
 
     if connected:
         return ConnectionStatusResponse(status="ACTIVE", email=f"{x_user_id}@connected")
@@ -100,20 +149,30 @@ class ConnectedAccount(BaseModel):
     connectedAt: str
 
 
-@app.get("/api/composio/connections")
-async def get_connections(x_user_id: str = Header(default="default")):
+# user_id -> assembled account list for connected users
+_connections_cache: TTLCache = TTLCache(maxsize=10_000, ttl=15)
+
+
+@app.get("/api/composio/connections", response_model=list[ConnectedAccount])
+async def get_connections(
+    service: ComposioDep,
+    x_user_id: str = Header(default="default"),
+):
     """Get all connected accounts for user."""
-    from datetime import datetime
+    cached = _connections_cache.get(x_user_id)
+    if cached is not None:
+        return cached
 
-    service = get_composio_service()
     accounts = []
 
-    if service.is_connected(x_user_id):
+    if await asyncio.to_thread(service.is_connected, x_user_id):
         accounts.append(ConnectedAccount(
             provider="google-drive",
             email=f"{x_user_id}@connected",
             connectedAt=datetime.now().isoformat(),
         ))
+        # Like the status cache, only remember users who are connected
+        _connections_cache[x_user_id] = accounts
 
     return accounts
 
@@ -132,45 +191,56 @@ class SpreadsheetFile(BaseModel):
     path: Optional[str] = None
 
 
-@app.get("/api/spreadsheets")
+_spreadsheet_list_adapter = TypeAdapter(list[SpreadsheetFile])
+
+
+@app.get("/api/spreadsheets", response_model=list[SpreadsheetFile])
 async def get_spreadsheets(
+    service: ComposioDep,
     provider: str = Query(default="google-drive"),
-    x_user_id: str = Header(default="default")
+    refresh: bool = Query(default=False),
+    x_user_id: str = Header(default="default"),
 ):
-    """List user's spreadsheet files from cloud provider."""
-    print(f"📂 Listing spreadsheets for user: {x_user_id}, provider: {provider}")
-    service = get_composio_service()
+    """
+    List user's spreadsheet files from cloud provider.
+    Pass refresh=true after adding or removing files in Drive to bypass the cached listing.
+    """
+    logger.info(f"📂 Listing spreadsheets for user: {x_user_id}, provider: {provider}")
 
-    if not service.is_connected(x_user_id):
-        print(f"❌ User {x_user_id} not connected to cloud provider")
+    if not await asyncio.to_thread(service.is_connected, x_user_id):
+        logger.info(f"❌ User {x_user_id} not connected to cloud provider")
         raise HTTPException(status_code=401, detail="Not connected to cloud provider")
 
-    print(f"✅ User connected, fetching files...")
-    files = service.list_spreadsheet_files(x_user_id)
-    print(f"📊 Found {len(files)} files total")
-
-    # Log each file found
-    for f in files:
-        print(f"   - {f['name']} ({f['mimeType']})")
-
-    # Transform to match frontend expectations
-    return [
-        SpreadsheetFile(
-            id=f["id"],
-            name=f["name"],
-            mimeType=f["mimeType"],
-            modifiedTime=f.get("modifiedTime"),
-            source=provider,
-        )
+    if refresh:
+        await asyncio.to_thread(service.invalidate_files, x_user_id)
+    files = await asyncio.to_thread(service.list_spreadsheet_files, x_user_id)
+    logger.info(f"📊 Found {len(files)} files total")
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for f in files:
+            logger.debug(f"   - {f['name']} ({f['mimeType']})")
+
+    # Transform to match frontend expectations (validated in one pydantic-core call)
+    return _spreadsheet_list_adapter.validate_python([
+        {
+            "id": f["id"],
+            "name": f["name"],
+            "mimeType": f["mimeType"],
+            "modifiedTime": f.get("modifiedTime"),
+            "source": provider,
+        }
         for f in files
-    ]
+    ])
 
 
 # Keep old endpoint for backwards compatibility
-@app.get("/api/files")
-async def list_files(x_user_id: str = Header(default="default")):
+@app.get("/api/files", response_model=list[SpreadsheetFile])
+async def list_files(
+    service: ComposioDep,
+    x_user_id: str = Header(default="default"),
+):
     """List user's CSV and spreadsheet files from Google Drive."""
-    return await get_spreadsheets(provider="google-drive", x_user_id=x_user_id)
+    return await get_spreadsheets(provider="google-drive", refresh=False, x_user_id=x_user_id, service=service)
 
 
 # =============================================================================
@@ -221,11 +291,21 @@ class ChatMessage(BaseModel):
     timestamp: str
 
 
+# Only the most recent messages are sent to Gemini
+CHAT_HISTORY_LIMIT = 5
+
+
 class ChatContext(BaseModel):
     schema: Optional[SchemaData] = None
     metrics: Optional[DataMetrics] = None
     conversationHistory: list[ChatMessage] = []
 
+    @field_validator("conversationHistory", mode="before")
+    @classmethod
+    def keep_recent_history(cls, v):
+        """Drop older messages before they are validated into ChatMessage objects."""
+        return v[-CHAT_HISTORY_LIMIT:] if isinstance(v, list) else v
+
 
 class ChatRequest(BaseModel):
     projectId: str
@@ -238,19 +318,26 @@ class ChatResponse(BaseModel):
     sources: Optional[list[str]] = None
 
 
+CHAT_PROMPT_TEMPLATE = """You are a helpful data analyst assistant. You help users understand their data.
+
+Context about the user's data:
+{context}
+
+Recent conversation:
+{history}
+
+User's question: {message}
+
+Provide a helpful, concise response about their data. Use markdown formatting for clarity."""
+
+
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest, x_user_id: str = Header(default="default")):
+async def chat(
+    request: ChatRequest,
+    gemini: GeminiDep,
+    x_user_id: str = Header(default="default"),
+):
     """Chat with Gemini about the data."""
-    from app.services.gemini import GeminiService
-
-    settings = get_settings()
-    gemini = GeminiService(
-        api_key=settings.gemini_api_key,
-        project_id=settings.gcp_project_id,
-        location=settings.gcp_location,
-        use_vertex_ai=settings.use_vertex_ai
-    )
-
     # Build context from schema and metrics
     context_parts = []
 
@@ -266,28 +353,18 @@ async def chat(request: ChatRequest, x_user_id: str = Header(default="default"))
     # Build conversation history
     history = "\n".join([
         f"{msg.role}: {msg.content}"
-        for msg in request.context.conversationHistory[-5:]  # Last 5 messages
+        for msg in request.context.conversationHistory  # Already trimmed to the last few
     ])
 
     # Create prompt for Gemini
-    prompt = f"""You are a helpful data analyst assistant. You help users understand their data.
-
-Context about the user's data:
-{chr(10).join(context_parts) if context_parts else "No data loaded yet."}
-
-Recent conversation:
-{history if history else "This is the start of the conversation."}
-
-User's question: {request.message}
-
-Provide a helpful, concise response about their data. Use markdown formatting for clarity."""
+    prompt = CHAT_PROMPT_TEMPLATE.format_map({
+        "context": "\n".join(context_parts) or "No data loaded yet.",
+        "history": history or "This is the start of the conversation.",
+        "message": request.message,
+    })
 
     try:
-        response = gemini.client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=prompt
-        )
-        return ChatResponse(message=response.text)
+        return ChatResponse(message=await asyncio.to_thread(gemini.generate_text, prompt))
     except Exception as e:
         return ChatResponse(message=f"I encountered an error: {str(e)}. Please try again.")
 
@@ -298,6 +375,8 @@ Provide a helpful, concise response about their data. Use markdown formatting fo
 
 class PreviewRequest(BaseModel):
     file_ids: list[str]
+    # Set to False to get previews only and fetch full files via /api/preview/{file_id}/stream
+    include_contents: bool = True
 
 
 class PreviewResponse(BaseModel):
@@ -337,23 +416,104 @@ class MigrateResponse(BaseModel):
     logs: list[str] = []
 
 
+_migrate_adapter = TypeAdapter(MigrateResponse)
+
+
+class ProgressLog:
+    """Collects progress messages for the response and mirrors them to the app logger."""
+
+    def __init__(self, on_log: Optional[Callable[[str], None]] = None):
+        self.lines: list[str] = []
+        self.on_log = on_log
+
+    def __call__(self, msg: str) -> None:
+        logger.info(msg)
+        self.lines.append(msg)
+        if self.on_log:
+            self.on_log(msg)
+
+
+def _head_lines(content: str, count: int) -> list[str]:
+    """First `count` lines of content, without splitting the rest of the file."""
+    return content.split('\n', count)[:count]
+
+
+async def _download_files(
+    composio: ComposioService,
+    x_user_id: str,
+    file_ids: list[str],
+    log: Callable[[str], None],
+    on_downloaded: Optional[Callable[[str, str], None]] = None,
+) -> tuple[dict[str, str], list[str]]:
+    """
+    Download Drive files concurrently, at most MAX_CONCURRENT_TRANSFERS at a time.
+    Returns (name -> content, error messages). Results are logged in file_ids order.
+    on_downloaded is called with (name, content) as soon as each file arrives.
+    Files are keyed by table name, so when two files map to the same name the
+    first to arrive is kept and the other is reported as an error.
+    """
+    # A double-clicked file shouldn't be downloaded (and later inserted) twice
+    unique_ids = list(dict.fromkeys(file_ids))
+    if len(unique_ids) < len(file_ids):
+        log(f"   ℹ️ Skipping {len(file_ids) - len(unique_ids)} duplicate file id(s)")
+        file_ids = unique_ids
+
+    # Resolve file names/types up front so downloads don't each look them up
+    file_infos = await asyncio.to_thread(composio.get_files_info, x_user_id, file_ids)
+    slots = asyncio.Semaphore(MAX_CONCURRENT_TRANSFERS)
+    # table name -> file id that claimed it; claimed before on_downloaded runs,
+    # so the content handed on is always the content returned
+    claimed: dict[str, str] = {}
+
+    async def download(file_id: str):
+        info = file_infos.get(file_id, {})
+        async with slots:
+            result = await asyncio.to_thread(
+                composio.download_file, x_user_id, file_id,
+                info.get("mimeType", ""), info.get("name", ""),
+            )
+        name = result[0]
+        if claimed.setdefault(name, file_id) != file_id:
+            raise ValueError(f"table name '{name}' is already used by file {claimed[name]}")
+        if on_downloaded:
+            on_downloaded(*result)
+        return result
+
+    results = await asyncio.gather(
+        *[download(file_id) for file_id in file_ids],
+        return_exceptions=True,
+    )
+
+    contents = {}
+    errors = []
+    for file_id, result in zip(file_ids, results):
+        if isinstance(result, Exception):
+            log(f"   ❌ Failed to download {file_id}: {str(result)}")
+            errors.append(f"Failed to download file {file_id}: {str(result)}")
+            continue
+        name, content = result
+        log(f"   ✅ Downloaded '{name}' ({len(content):,} bytes)")
+        contents[name] = content
+    return contents, errors
+
+
 @app.post("/api/preview", response_model=PreviewResponse)
-async def preview_files(request: PreviewRequest, x_user_id: str = Header(default="default")):
+async def preview_files(
+    request: PreviewRequest,
+    composio: ComposioDep,
+    x_user_id: str = Header(default="default"),
+):
     """
     Download files and return their contents WITHOUT calling Gemini.
     Use this to preview data before schema inference.
     """
-    logs = []
-    def log(msg: str):
-        print(msg)
-        logs.append(msg)
+    log = ProgressLog()
+    logs = log.lines
 
     log("📥 Downloading files for preview...")
     log(f"📁 Processing {len(request.file_ids)} file(s)")
 
-    composio = get_composio_service()
-
-    if not composio.is_connected(x_user_id):
+    if not await asyncio.to_thread(composio.is_connected, x_user_id):
         return PreviewResponse(
             success=False,
             file_contents={},
@@ -363,18 +523,12 @@ async def preview_files(request: PreviewRequest, x_user_id: str = Header(default
         )
 
     # Download files
-    file_contents = {}
+    file_contents, _ = await _download_files(composio, x_user_id, request.file_ids, log)
     file_previews = {}
-    for file_id in request.file_ids:
-        try:
-            name, content = composio.download_file(x_user_id, file_id)
-            log(f"   ✅ Downloaded '{name}' ({len(content):,} bytes)")
-            file_contents[name] = content
-            # Store first 10 rows for preview
-            lines = content.split('\n')[:11]
-            file_previews[name] = lines
-        except Exception as e:
-            log(f"   ❌ Failed to download {file_id}: {str(e)}")
+    for name, content in file_contents.items():
+        # Store first 10 rows for preview
+        lines = _head_lines(content, 11)
+        file_previews[name] = lines
 
     if not file_contents:
         return PreviewResponse(
@@ -388,38 +542,55 @@ async def preview_files(request: PreviewRequest, x_user_id: str = Header(default
     log(f"✅ Downloaded {len(file_contents)} file(s)")
     return PreviewResponse(
         success=True,
-        file_contents=file_contents,
+        file_contents=file_contents if request.include_contents else {},
         file_previews=file_previews,
         logs=logs,
     )
 
 
+# Chunk size for streamed file downloads
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+@app.get("/api/preview/{file_id}/stream")
+async def stream_file(
+    file_id: str,
+    composio: ComposioDep,
+    x_user_id: str = Header(default="default"),
+):
+    """Stream a single file's CSV content in chunks instead of embedding it in JSON."""
+    if not await asyncio.to_thread(composio.is_connected, x_user_id):
+        raise HTTPException(status_code=401, detail="Google Drive not connected")
+
+    try:
+        _, content = await asyncio.to_thread(composio.download_file, x_user_id, file_id)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Failed to download {file_id}: {str(e)}")
+
+    def chunks():
+        for start in range(0, len(content), STREAM_CHUNK_SIZE):
+            yield content[start:start + STREAM_CHUNK_SIZE].encode("utf-8")
+
+    return StreamingResponse(chunks(), media_type="text/csv")
+
+
 @app.post("/api/analyze", response_model=AnalyzeResponse)
-async def analyze_files(request: AnalyzeRequest, x_user_id: str = Header(default="default")):
+async def analyze_files(
+    request: AnalyzeRequest,
+    composio: ComposioDep,
+    gemini: GeminiDep,
+    x_user_id: str = Header(default="default"),
+):
     """
     Analyze files and propose a schema WITHOUT creating tables.
     If file_contents is provided, uses that directly (no download needed).
     Otherwise downloads from Google Drive.
     """
-    from app.services.gemini import GeminiService
-
-    logs = []
-    def log(msg: str):
-        print(msg)
-        logs.append(msg)
+    log = ProgressLog()
+    logs = log.lines
 
     log("🔍 Analyzing files...")
 
-    settings = get_settings()
-
-    # Initialize Gemini
-    gemini = GeminiService(
-        api_key=settings.gemini_api_key,
-        project_id=settings.gcp_project_id,
-        location=settings.gcp_location,
-        use_vertex_ai=settings.use_vertex_ai
-    )
-
     # Use provided file contents if available, otherwise download
     csv_data = {}
     file_previews = {}
@@ -428,14 +599,13 @@ async def analyze_files(request: AnalyzeRequest, x_user_id: str = Header(default
         log(f"📁 Using {len(request.file_contents)} pre-loaded file(s)")
         csv_data = request.file_contents
         for name, content in csv_data.items():
-            lines = content.split('\n')[:6]
+            lines = _head_lines(content, 6)
             file_previews[name] = lines
             log(f"   ✅ {name} ({len(content):,} bytes)")
     else:
         log(f"📁 Processing {len(request.file_ids)} file(s)")
-        composio = get_composio_service()
 
-        if not composio.is_connected(x_user_id):
+        if not await asyncio.to_thread(composio.is_connected, x_user_id):
             return AnalyzeResponse(
                 success=False,
                 proposed_ddl="",
@@ -446,15 +616,10 @@ async def analyze_files(request: AnalyzeRequest, x_user_id: str = Header(default
 
         # Download files
         log("📥 Downloading files from Google Drive...")
-        for file_id in request.file_ids:
-            try:
-                name, content = composio.download_file(x_user_id, file_id)
-                log(f"   ✅ Downloaded '{name}' ({len(content):,} bytes)")
-                csv_data[name] = content
-                lines = content.split('\n')[:6]
-                file_previews[name] = lines
-            except Exception as e:
-                log(f"   ❌ Failed to download {file_id}: {str(e)}")
+        csv_data, _ = await _download_files(composio, x_user_id, request.file_ids, log)
+        for name, content in csv_data.items():
+            lines = _head_lines(content, 6)
+            file_previews[name] = lines
 
     if not csv_data:
         return AnalyzeResponse(
@@ -468,7 +633,7 @@ async def analyze_files(request: AnalyzeRequest, x_user_id: str = Header(default
     # Step 2: Infer schema with Gemini
     log("🤖 Analyzing data with Gemini AI...")
     try:
-        ddl = gemini.infer_schema(csv_data)
+        ddl = await gemini.infer_schema_async(csv_data)
         log("✅ Schema inference complete!")
         log("📋 Review the proposed schema below and edit if needed")
     except Exception as e:
@@ -489,36 +654,51 @@ async def analyze_files(request: AnalyzeRequest, x_user_id: str = Header(default
     )
 
 
-@app.post("/api/migrate", response_model=MigrateResponse)
-async def migrate_files(request: MigrateRequest, x_user_id: str = Header(default="default")):
+async def _run_migration(
+    request: MigrateRequest,
+    x_user_id: str,
+    composio: ComposioService,
+    gemini: GeminiService,
+    postgres: PostgresService,
+    on_log: Optional[Callable[[str], None]] = None,
+) -> MigrateResponse:
     """
-    Create tables in Postgres and insert data.
-    If file_contents is provided, uses that directly (no download needed).
+    Run a migration end to end. Raises HTTPException on fatal errors.
+    on_log is called with each progress message as it is produced.
     """
-    from app.services.gemini import GeminiService
-    from app.services.postgres import PostgresService
-
     # Collect logs to return to frontend
-    logs = []
-    def log(msg: str):
-        print(msg)  # Also print to console
-        logs.append(msg)
+    log = ProgressLog(on_log)
+    logs = log.lines
 
     log("🚀 Migration started")
 
-    settings = get_settings()
     errors = []
+    transfer_slots = asyncio.Semaphore(MAX_CONCURRENT_TRANSFERS)
+    ddl = request.custom_ddl
 
-    # Initialize services
-    log("⚙️ Initializing services...")
-    gemini = GeminiService(
-        api_key=settings.gemini_api_key,
-        project_id=settings.gcp_project_id,
-        location=settings.gcp_location,
-        use_vertex_ai=settings.use_vertex_ai
-    )
-    postgres = PostgresService(db_url=settings.render_db_url)
-    log("✅ Services initialized")
+    def create_tables() -> asyncio.Task:
+        # Its progress is logged where the task is awaited, so Step 3 never shows
+        # up between the download lines when it starts early
+        return asyncio.create_task(asyncio.to_thread(postgres.create_tables, ddl))
+
+    tables_task: Optional[asyncio.Task] = None
+    inserts: dict[str, asyncio.Task] = {}
+
+    async def insert(name: str, content: str):
+        await tables_task
+        async with transfer_slots:
+            return await asyncio.to_thread(postgres.insert_csv_data, name, content)
+
+    def start_insert(name: str, content: str):
+        nonlocal tables_task
+        if name in inserts:
+            return
+        if tables_task is None:
+            tables_task = create_tables()
+        inserts[name] = asyncio.create_task(insert(name, content))
+
+    if ddl:
+        log("📝 Using user-provided schema")
 
     # Use provided file contents if available, otherwise download
     csv_data = {}
@@ -530,22 +710,20 @@ async def migrate_files(request: MigrateRequest, x_user_id: str = Header(default
             log(f"   ✅ {name} ({len(content):,} bytes)")
     else:
         log(f"📁 Processing {len(request.file_ids)} file(s)")
-        composio = get_composio_service()
 
-        if not composio.is_connected(x_user_id):
+        if not await asyncio.to_thread(composio.is_connected, x_user_id):
             log("❌ Google Drive not connected!")
             raise HTTPException(status_code=401, detail="Google Drive not connected")
 
-        # Download files from Drive
+        # Download files from Drive. A user-provided schema doesn't depend on the
+        # data, so tables are created when the first file lands and every file is
+        # inserted as soon as it is downloaded.
         log("📥 Downloading files from Google Drive...")
-        for file_id in request.file_ids:
-            try:
-                name, content = composio.download_file(x_user_id, file_id)
-                log(f"   ✅ Downloaded '{name}' ({len(content):,} bytes)")
-                csv_data[name] = content
-            except Exception as e:
-                log(f"   ❌ Failed to download {file_id}: {str(e)}")
-                errors.append(f"Failed to download file {file_id}: {str(e)}")
+        csv_data, download_errors = await _download_files(
+            composio, x_user_id, request.file_ids, log,
+            on_downloaded=start_insert if ddl else None,
+        )
+        errors.extend(download_errors)
 
     if not csv_data:
         log("❌ No files to migrate!")
@@ -553,48 +731,64 @@ async def migrate_files(request: MigrateRequest, x_user_id: str = Header(default
 
     log(f"📊 Ready to migrate {len(csv_data)} file(s): {', '.join(csv_data.keys())}")
 
-    # Step 2: Get schema (use custom DDL if provided, otherwise infer)
-    if request.custom_ddl:
-        log("📝 Step 2: Using user-provided schema")
-        ddl = request.custom_ddl
-        log("✅ Custom schema loaded")
-    else:
+    # Step 2: Infer the schema unless the user provided one
+    if not ddl:
         log("🤖 Step 2: Analyzing data with Gemini AI...")
         try:
-            ddl = gemini.infer_schema(csv_data)
+            ddl = await gemini.infer_schema_async(csv_data)
             log("✅ Schema inference complete!")
         except Exception as e:
             log(f"❌ Schema inference failed: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Schema inference failed: {str(e)}")
 
-    # Step 3: Create tables in Postgres (without FK constraints)
+    # Step 3: Create tables in Postgres (without FK constraints), unless that
+    # already started during the download
     log("🗄️ Step 3: Creating tables in PostgreSQL...")
+    if tables_task is None:
+        tables_task = create_tables()
     try:
-        tables, fk_constraints = postgres.create_tables(ddl)
-        log(f"✅ Created {len(tables)} table(s): {', '.join(tables)}")
-        if fk_constraints:
-            log(f"   📌 Found {len(fk_constraints)} foreign key constraint(s) to add after data insertion")
+        tables, fk_constraints, indexes = await tables_task
     except Exception as e:
         log(f"❌ Table creation failed: {str(e)}")
+        await asyncio.gather(*inserts.values(), return_exceptions=True)
         raise HTTPException(status_code=500, detail=f"Table creation failed: {str(e)}")
+    log(f"✅ Created {len(tables)} table(s): {', '.join(tables)}")
+    if fk_constraints:
+        log(f"   📌 Found {len(fk_constraints)} foreign key constraint(s) to add after data insertion")
+    if indexes:
+        log(f"   📌 Found {len(indexes)} index(es) to build after data insertion")
 
     # Step 4: Insert data
     log("📝 Step 4: Inserting data...")
     rows_inserted = {}
+
     for name, content in csv_data.items():
+        start_insert(name, content)
+
+    results = await asyncio.gather(*inserts.values(), return_exceptions=True)
+    for name, result in zip(inserts, results):
+        if isinstance(result, Exception):
+            log(f"   ❌ Failed to insert data for {name}: {str(result)}")
+            errors.append(f"Failed to insert data for {name}: {str(result)}")
+            continue
+        rows_inserted[name] = result
+        log(f"   ✅ Inserted {result:,} rows into '{name}'")
+
+    # Indexes are built once over the loaded rows rather than maintained per row
+    if indexes:
+        log(f"   🗂️ Building {len(indexes)} index(es)...")
         try:
-            count = postgres.insert_csv_data(name, content)
-            rows_inserted[name] = count
-            log(f"   ✅ Inserted {count:,} rows into '{name}'")
+            added_indexes = await asyncio.to_thread(postgres.add_indexes, indexes)
+            log(f"   ✅ Built {len(added_indexes)} of {len(indexes)} index(es)")
         except Exception as e:
-            log(f"   ❌ Failed to insert data for {name}: {str(e)}")
-            errors.append(f"Failed to insert data for {name}: {str(e)}")
+            log(f"   ⚠️ Index creation failed: {str(e)}")
+            errors.append(f"Index creation error: {str(e)}")
 
     # Step 5: Add foreign key constraints after all data is inserted
     if fk_constraints:
         log("🔗 Step 5: Adding foreign key constraints...")
         try:
-            added_fks = postgres.add_foreign_keys(fk_constraints)
+            added_fks = await asyncio.to_thread(postgres.add_foreign_keys, fk_constraints)
             for fk in added_fks:
                 log(f"   ✅ Added FK: {fk}")
         except Exception as e:
@@ -617,6 +811,64 @@ async def migrate_files(request: MigrateRequest, x_user_id: str = Header(default
     )
 
 
+@app.post("/api/migrate", responses={200: {"model": MigrateResponse}})
+async def migrate_files(
+    request: MigrateRequest,
+    composio: ComposioDep,
+    gemini: GeminiDep,
+    postgres: PostgresDep,
+    x_user_id: str = Header(default="default"),
+):
+    """
+    Create tables in Postgres and insert data.
+    If file_contents is provided, uses that directly (no download needed).
+    """
+    result = await _run_migration(request, x_user_id, composio, gemini, postgres)
+    # Serialize once here rather than letting FastAPI re-validate the large logs/ddl payload
+    return Response(content=_migrate_adapter.dump_json(result), media_type="application/json")
+
+
+@app.post("/api/migrate/stream")
+async def migrate_files_stream(
+    request: MigrateRequest,
+    composio: ComposioDep,
+    gemini: GeminiDep,
+    postgres: PostgresDep,
+    x_user_id: str = Header(default="default"),
+):
+    """
+    Same as /api/migrate, but streams progress as NDJSON.
+    Emits {"log": ...} lines as the migration runs, then a final
+    {"result": MigrateResponse} or {"error": ..., "status_code": ...} line.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def run():
+        try:
+            result = await _run_migration(
+                request, x_user_id, composio, gemini, postgres,
+                on_log=lambda msg: events.put_nowait({"log": msg}),
+            )
+            events.put_nowait({"result": result.model_dump(mode="json")})
+        except HTTPException as e:
+            events.put_nowait({"error": e.detail, "status_code": e.status_code})
+        except Exception as e:
+            events.put_nowait({"error": str(e), "status_code": 500})
+        finally:
+            events.put_nowait(None)
+
+    async def stream():
+        task = asyncio.create_task(run())
+        try:
+            while (event := await events.get()) is not None:
+                yield json.dumps(event) + "\n"
+        finally:
+            # Client went away before the migration finished
+            task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 # =============================================================================
 # Query Endpoint - Execute SQL queries
 # =============================================================================
@@ -633,31 +885,35 @@ class QueryResponse(BaseModel):
     error: str = ""
 
 
-@app.post("/api/query", response_model=QueryResponse)
-async def execute_query(request: QueryRequest):
-    """Execute a SQL query against the database."""
-    from app.services.postgres import PostgresService
+_query_adapter = TypeAdapter(QueryResponse)
 
-    settings = get_settings()
-    postgres = PostgresService(db_url=settings.render_db_url)
 
+@app.post("/api/query", responses={200: {"model": QueryResponse}})
+async def execute_query(
+    request: QueryRequest,
+    postgres: PostgresDep,
+):
+    """Execute a SQL query against the database."""
     sql = request.sql.strip()
 
     # Basic safety: only allow SELECT queries
-    if not sql.upper().startswith("SELECT"):
+    if sql[:6].upper() != "SELECT":
         return QueryResponse(
             success=False,
             error="Only SELECT queries are allowed"
         )
 
     try:
-        columns, rows = postgres.execute_query(sql)
-        return QueryResponse(
+        columns, rows = await asyncio.to_thread(postgres.execute_query, sql)
+        # The rows come straight from the driver, so skip validating every cell
+        # and serialize the result once
+        result = QueryResponse.model_construct(
             success=True,
             columns=columns,
             rows=rows,
             row_count=len(rows),
         )
+        return Response(content=_query_adapter.dump_json(result), media_type="application/json")
     except Exception as e:
         return QueryResponse(
             success=False,
@@ -665,16 +921,41 @@ async def execute_query(request: QueryRequest):
         )
 
 
-@app.get("/api/tables")
-async def list_tables():
-    """List all tables in the database."""
-    from app.services.postgres import PostgresService
+@app.post("/api/query/stream")
+async def execute_query_stream(
+    request: QueryRequest,
+    postgres: PostgresDep,
+):
+    """
+    Same as /api/query, but streams the result as NDJSON from a server-side cursor:
+    a {"columns": [...]} line, then one JSON array per row. Failures are reported
+    as a final {"error": ...} line.
+    """
+    sql = request.sql.strip()
+
+    def lines():
+        if sql[:6].upper() != "SELECT":
+            yield to_json({"error": "Only SELECT queries are allowed"}) + b"\n"
+            return
+        batches = postgres.stream_query(sql)
+        try:
+            for i, (columns, rows) in enumerate(batches):
+                # One chunk per batch keeps the per-row threadpool hops out of the loop
+                chunk = b"".join(to_json(row) + b"\n" for row in rows)
+                yield to_json({"columns": columns}) + b"\n" + chunk if i == 0 else chunk
+        except Exception as e:
+            yield to_json({"error": str(e)}) + b"\n"
+        finally:
+            batches.close()
 
-    settings = get_settings()
-    postgres = PostgresService(db_url=settings.render_db_url)
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
+
+@app.get("/api/tables")
+async def list_tables(postgres: PostgresDep):
+    """List all tables in the database."""
     try:
-        tables = postgres.list_tables()
+        tables = await asyncio.to_thread(postgres.list_tables)
         return {"tables": tables}
     except Exception as e:
         return {"tables": [], "error": str(e)}
@@ -685,23 +966,37 @@ async def list_tables():
 # =============================================================================
 
 @app.get("/api/auth/status")
-async def auth_status(x_user_id: str = Header(default="default")):
+async def auth_status(
+    service: ComposioDep,
+    x_user_id: str = Header(default="default"),
+):
     """Check if Google Drive is connected for this user."""
-    service = get_composio_service()
-    connected = service.is_connected(x_user_id)
+    connected = await asyncio.to_thread(service.is_connected, x_user_id)
     return {"connected": connected, "user_id": x_user_id}
 
 
 @app.post("/api/auth/connect-drive")
-async def connect_drive(x_user_id: str = Header(default="default")):
+async def connect_drive(
+    service: ComposioDep,
+    x_user_id: str = Header(default="default"),
+):
     """Get OAuth redirect URL for Google Drive connection."""
-    service = get_composio_service()
-    settings = get_settings()
-    redirect_url = service.get_auth_url(x_user_id, settings.frontend_url, use_drive=True)
+    service.invalidate(x_user_id)
+    _connections_cache.pop(x_user_id, None)
+    redirect_url = await asyncio.to_thread(service.get_auth_url, x_user_id, settings.frontend_url, use_drive=True)
     return {"redirect_url": redirect_url}
 
 
 @app.get("/api/auth/callback")
-async def auth_callback(code: str = Query(default=""), state: str = Query(default="")):
+async def auth_callback(
+    service: ComposioDep,
+    code: str = Query(default=""),
+    state: str = Query(default=""),
+):
     """OAuth callback from Google - Composio handles this automatically."""
+    # The callback doesn't say which user connected, so forget every cached
+    # status; a user who just added Drive to a Sheets-only connection must
+    # not keep seeing the old answer
+    service.invalidate()
+    _connections_cache.clear()
     return {"status": "connected", "message": "Google Drive connected successfully"}
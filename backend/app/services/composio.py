@@ -1,48 +1,140 @@
 from composio import Composio, ComposioToolSet
+from cachetools import LRUCache, TTLCache
+from concurrent.futures import Future
+from pathlib import Path
+import csv
+import io
+import json
 import logging
+import re
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Trailing ".ext" and runs of characters that aren't valid in a bare SQL identifier
+_EXT_RE = re.compile(r'\.[^.]*$')
+_TBL_RE = re.compile(r'\W+')
+
+# Drive fields requested when listing files
+DRIVE_LIST_FIELDS = "nextPageToken,files(id,name,mimeType,modifiedTime)"
+
+# Files listed as spreadsheets/CSVs: any of these mime types, or any of these extensions
+ALLOWED_MIME_TYPES = frozenset({
+    'text/csv',
+    'text/plain',
+    'application/vnd.google-apps.spreadsheet',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.ms-excel',
+})
+ALLOWED_EXTENSIONS = ('.csv', '.xlsx', '.xls')
+
+# The same filter as a Drive search, so non-spreadsheet files are never paged through
+DRIVE_SPREADSHEET_QUERY = " or ".join(
+    [f"mimeType = '{mime}'" for mime in sorted(ALLOWED_MIME_TYPES)]
+    + [f"name contains '{ext}'" for ext in ALLOWED_EXTENSIONS]
+)
+
+# Seconds to wait on the optional Redis cache before falling back to Drive
+REDIS_TIMEOUT = 2
 
-class ComposioService:
-    # Class-level cache for file lists (simple in-memory cache)
-    _file_cache: dict[str, list[dict]] = {}
 
-    def __init__(self, api_key: str, auth_config_id: str, drive_auth_config_id: str = ""):
+class ComposioService:
+    def __init__(
+        self,
+        api_key: str,
+        auth_config_id: str,
+        drive_auth_config_id: str = "",
+        file_cache_ttl: int = 300,
+        redis_url: str = "",
+    ):
         self.api_key = api_key
         self.auth_config_id = auth_config_id
         self.drive_auth_config_id = drive_auth_config_id or auth_config_id
         self.sdk = Composio(api_key=api_key) if api_key else None
+        # user_id -> (has_drive, has_sheets). Only active connections are cached,
+        # so users still waiting on OAuth are re-checked on every poll.
+        self._status_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+        self._status_lock = threading.Lock()
+        # user_id -> {file_id: file} listing. Bounded and expiring so files added in
+        # Drive show up eventually and idle users don't pin memory.
+        self._file_cache: TTLCache = TTLCache(maxsize=256, ttl=file_cache_ttl)
+        self._file_cache_lock = threading.RLock()
+        self._file_cache_ttl = file_cache_ttl
+        # Optional second level shared by all workers, so one worker's Drive scan
+        # serves the others
+        self._redis = None
+        if redis_url:
+            import redis  # Only needed when REDIS_URL is set
+            self._redis = redis.Redis.from_url(
+                redis_url, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT
+            )
+        # user_id -> ComposioToolSet. Its HTTP client is a requests.Session, so
+        # reusing it keeps the TLS connection to Composio alive between calls.
+        self._toolsets: LRUCache = LRUCache(maxsize=256)
+        self._toolsets_lock = threading.Lock()
+        # user_id -> listing in progress, so concurrent requests share one Drive scan
+        self._listings_inflight: dict[str, Future] = {}
+        self._listings_lock = threading.Lock()
 
     def _get_toolset(self, user_id: str) -> ComposioToolSet:
-        """Get a ComposioToolSet for executing actions."""
-        return ComposioToolSet(api_key=self.api_key, entity_id=user_id)
+        """Get a ComposioToolSet for executing actions, reusing the user's existing one."""
+        with self._toolsets_lock:
+            toolset = self._toolsets.get(user_id)
+        if toolset is not None:
+            return toolset
+
+        # Built outside the lock: the constructor talks to Composio and shouldn't
+        # hold up other users' lookups
+        toolset = ComposioToolSet(api_key=self.api_key, entity_id=user_id)
+        with self._toolsets_lock:
+            return self._toolsets.setdefault(user_id, toolset)
 
     def is_connected(self, user_id: str, require_drive: bool = True) -> bool:
         """Check if user has connected their Google Sheets/Drive."""
         if not self.sdk:
             return False
 
-        try:
-            entity = self.sdk.get_entity(user_id)
-            connections = entity.get_connections()
-            has_drive = False
-            has_sheets = False
-            for conn in connections:
-                app_name = getattr(conn, 'appName', '') or getattr(conn, 'app_name', '') or ''
-                status = getattr(conn, 'status', 'ACTIVE')
-                if status != "ACTIVE":
-                    continue
-                if app_name.lower() in ['googledrive', 'google_drive']:
-                    has_drive = True
-                if app_name.lower() in ['googlesheets', 'google_sheets']:
-                    has_sheets = True
-
-            if require_drive:
-                return has_drive
-            return has_drive or has_sheets
-        except Exception:
-            return False
+        with self._status_lock:
+            cached = self._status_cache.get(user_id)
+
+        if cached is None:
+            try:
+                cached = self._fetch_connection_status(user_id)
+            except Exception:
+                return False
+            if any(cached):
+                with self._status_lock:
+                    self._status_cache[user_id] = cached
+
+        has_drive, has_sheets = cached
+        if require_drive:
+            return has_drive
+        return has_drive or has_sheets
+
+    def _fetch_connection_status(self, user_id: str) -> tuple[bool, bool]:
+        """Ask Composio which Google apps the user has active connections for."""
+        entity = self.sdk.get_entity(user_id)
+        connections = entity.get_connections()
+        has_drive = False
+        has_sheets = False
+        for conn in connections:
+            app_name = getattr(conn, 'appName', '') or getattr(conn, 'app_name', '') or ''
+            status = getattr(conn, 'status', 'ACTIVE')
+            if status != "ACTIVE":
+                continue
+            if app_name.lower() in ['googledrive', 'google_drive']:
+                has_drive = True
+            if app_name.lower() in ['googlesheets', 'google_sheets']:
+                has_sheets = True
+        return has_drive, has_sheets
+
+    def invalidate(self, user_id: str | None = None) -> None:
+        """Drop the cached connection status for a user, or for everyone if no user is given."""
+        with self._status_lock:
+            if user_id is None:
+                self._status_cache.clear()
+            else:
+                self._status_cache.pop(user_id, None)
 
     def get_auth_url(self, user_id: str, redirect_url: str, use_drive: bool = False) -> str:
         """Get OAuth URL for Google Drive/Sheets connection."""
@@ -64,12 +156,72 @@ class ComposioService:
 
     def get_file_info(self, user_id: str, file_id: str) -> dict | None:
         """Get file info from cache without re-fetching all files."""
-        cache_key = f"{user_id}_files"
-        if cache_key in ComposioService._file_cache:
-            for f in ComposioService._file_cache[cache_key]:
-                if f.get("id") == file_id:
-                    return f
-        return None
+        files = self._cached_files(user_id)
+        return files.get(file_id) if files else None
+
+    def _cached_files(self, user_id: str) -> dict[str, dict] | None:
+        """Look up a user's listing in memory, then in Redis if configured."""
+        with self._file_cache_lock:
+            files = self._file_cache.get(user_id)
+        if files is not None or self._redis is None:
+            return files
+
+        try:
+            raw = self._redis.get(self._redis_files_key(user_id))
+        except Exception as e:
+            logger.warning(f"Redis file cache read failed: {e}")
+            return None
+        if raw is None:
+            return None
+        files = json.loads(raw)
+        with self._file_cache_lock:
+            self._file_cache[user_id] = files
+        return files
+
+    def _store_files(self, user_id: str, files: dict[str, dict]) -> None:
+        with self._file_cache_lock:
+            self._file_cache[user_id] = files
+        if self._redis is not None:
+            try:
+                self._redis.set(self._redis_files_key(user_id), json.dumps(files), ex=self._file_cache_ttl)
+            except Exception as e:
+                logger.warning(f"Redis file cache write failed: {e}")
+
+    def _redis_files_key(self, user_id: str) -> str:
+        return f"composio:files:{user_id}"
+
+    def invalidate_files(self, user_id: str) -> None:
+        """Drop the cached file listing for a user."""
+        with self._file_cache_lock:
+            self._file_cache.pop(user_id, None)
+        if self._redis is not None:
+            try:
+                self._redis.delete(self._redis_files_key(user_id))
+            except Exception as e:
+                logger.warning(f"Redis file cache delete failed: {e}")
+
+    def get_files_info(self, user_id: str, file_ids: list[str]) -> dict[str, dict]:
+        """
+        Resolve name/mimeType for several files at once.
+        If more than one id is missing from the cached listing, the listing is
+        refreshed once instead of fetching metadata per file during download.
+        """
+        missing = [fid for fid in file_ids if self.get_file_info(user_id, fid) is None]
+        if len(missing) > 1:
+            self.list_spreadsheet_files(user_id, use_cache=False)
+
+        infos = {}
+        for file_id in file_ids:
+            info = self.get_file_info(user_id, file_id)
+            if info:
+                infos[file_id] = info
+        return infos
+
+    def _invalidate_if_missing(self, user_id: str, error) -> None:
+        """Drop the user's cached listing when Drive says a file no longer exists."""
+        message = str(error or "").lower()
+        if "404" in message or "not found" in message:
+            self.invalidate_files(user_id)
 
     def list_spreadsheet_files(self, user_id: str, use_cache: bool = True) -> list[dict]:
         """List CSV and spreadsheet files from user's Google Drive."""
@@ -77,38 +229,62 @@ class ComposioService:
             raise ValueError("Composio API key not configured")
 
         # Check cache first
-        cache_key = f"{user_id}_files"
-        if use_cache and cache_key in ComposioService._file_cache:
-            logger.info(f"Using cached file list ({len(ComposioService._file_cache[cache_key])} files)")
-            return ComposioService._file_cache[cache_key]
+        if use_cache:
+            cached = self._cached_files(user_id)
+            if cached is not None:
+                logger.info(f"Using cached file list ({len(cached)} files)")
+                return list(cached.values())
+
+        with self._listings_lock:
+            listing = self._listings_inflight.get(user_id)
+            owner = listing is None
+            if owner:
+                listing = self._listings_inflight[user_id] = Future()
+        if not owner:
+            logger.info("Waiting on file listing already in progress")
+            return listing.result()
 
+        try:
+            files = self._fetch_spreadsheet_files(user_id)
+        except BaseException as e:
+            listing.set_exception(e)
+            raise
+        else:
+            listing.set_result(files)
+            return files
+        finally:
+            with self._listings_lock:
+                self._listings_inflight.pop(user_id, None)
+
+    def _fetch_spreadsheet_files(self, user_id: str) -> list[dict]:
+        """Page through the user's Drive and cache the spreadsheet/CSV files found."""
         toolset = self._get_toolset(user_id)
         logger.info("Fetching all files from Google Drive (with pagination)...")
 
-        # Composio's GOOGLEDRIVE_FIND_FILE ignores search_query, so we need to
-        # list ALL files and filter client-side
+        # Composio's GOOGLEDRIVE_FIND_FILE ignores search_query, so we list with
+        # a Drive query and still filter client-side in case it isn't applied
         all_files = {}
 
-        # Allowed mime types for spreadsheets/CSVs
-        allowed_mimes = {
-            'text/csv',
-            'text/plain',
-            'application/vnd.google-apps.spreadsheet',
-            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'application/vnd.ms-excel',
-        }
-        allowed_extensions = {'.csv', '.xlsx', '.xls'}
-
         page_token = None
         page_count = 0
         max_pages = 10  # Safety limit
+        # Pages in a row without a single spreadsheet; with newest-first ordering
+        # a run of these means the rest of the Drive is unlikely to have any
+        empty_pages = 0
+        max_empty_pages = 2
 
         try:
             while page_count < max_pages:
                 page_count += 1
                 logger.info(f"Fetching page {page_count}...")
 
-                params = {"max_results": 100}
+                params = {
+                    "max_results": 100,
+                    "q": DRIVE_SPREADSHEET_QUERY,
+                    "order_by": "modifiedTime desc",
+                    # Partial response: only what we keep below, instead of full file resources
+                    "fields": DRIVE_LIST_FIELDS,
+                }
                 if page_token:
                     params["page_token"] = page_token
 
@@ -121,6 +297,7 @@ class ComposioService:
                     data = result.get("data", result)
                     file_list = data.get("files", data.get("items", []))
                     logger.info(f"  Got {len(file_list)} files in this page")
+                    found_before = len(all_files)
 
                     for f in file_list:
                         file_id = f.get("id")
@@ -132,10 +309,7 @@ class ComposioService:
                             continue
 
                         # Check if it's a spreadsheet/CSV by mime type or extension
-                        is_allowed = (
-                            mime in allowed_mimes or
-                            any(name.lower().endswith(ext) for ext in allowed_extensions)
-                        )
+                        is_allowed = mime in ALLOWED_MIME_TYPES or name.lower().endswith(ALLOWED_EXTENSIONS)
 
                         if file_id and is_allowed:
                             all_files[file_id] = {
@@ -151,6 +325,11 @@ class ComposioService:
                     if not page_token:
                         logger.info("No more pages")
                         break
+
+                    empty_pages = 0 if len(all_files) > found_before else empty_pages + 1
+                    if empty_pages >= max_empty_pages:
+                        logger.info(f"No spreadsheets in the last {empty_pages} pages, stopping")
+                        break
                 else:
                     logger.warning(f"Unexpected result type: {type(result)}")
                     break
@@ -158,13 +337,12 @@ class ComposioService:
         except Exception as e:
             logger.error(f"Failed to list files: {e}")
 
-        files = list(all_files.values())
-        logger.info(f"Total spreadsheet/CSV files found: {len(files)}")
+        logger.info(f"Total spreadsheet/CSV files found: {len(all_files)}")
 
-        # Cache the results
-        ComposioService._file_cache[cache_key] = files
+        # Cache the results, indexed by id for get_file_info
+        self._store_files(user_id, all_files)
 
-        return files
+        return list(all_files.values())
 
     def download_file(self, user_id: str, file_id: str, mime_type: str = "", filename: str = "") -> tuple[str, str]:
         """
@@ -198,10 +376,11 @@ class ComposioService:
 
         logger.info(f"Downloading file: {filename} (mime: {mime_type})")
 
-        # Remove extension from filename for table name
-        name_without_ext = filename.rsplit(".", 1)[0] if "." in filename else filename
-        # Clean up name for SQL table (replace spaces, special chars)
-        table_name = name_without_ext.replace(" ", "_").replace("-", "_").lower()
+        # Remove extension and clean up the name for a SQL table (spaces, special chars)
+        table_name = _TBL_RE.sub('_', _EXT_RE.sub('', filename).lower()).strip('_')
+        # Names like "___.csv" or "(1).csv" leave nothing, or a leading digit
+        if not table_name or table_name[0].isdigit():
+            table_name = f"t_{table_name}"
 
         # For Google Sheets, use Sheets API to get data as CSV
         if mime_type == "application/vnd.google-apps.spreadsheet":
@@ -220,27 +399,22 @@ class ComposioService:
                 data = data["data"]
 
             if not data.get("valueRanges") and data.get("successful") == False:
+                self._invalidate_if_missing(user_id, data.get("error"))
                 raise Exception(f"Failed to read spreadsheet: {data.get('error')}")
 
-            # Convert to CSV format
-            ranges = data.get("valueRanges", [])
-            if ranges:
-                values = ranges[0].get("values", [])
-                csv_lines = []
-                for row in values:
-                    # Escape commas and quotes in values
-                    escaped = []
-                    for cell in row:
-                        cell_str = str(cell) if cell else ""
-                        if "," in cell_str or '"' in cell_str or "\n" in cell_str:
-                            cell_str = '"' + cell_str.replace('"', '""') + '"'
-                        escaped.append(cell_str)
-                    csv_lines.append(",".join(escaped))
-                content = "\n".join(csv_lines)
-                logger.info(f"Read {len(values)} rows from Google Sheet")
-                return table_name, content
-
-            return table_name, ""
+            try:
+                values = data["valueRanges"][0]["values"]
+            except (KeyError, IndexError, TypeError):
+                values = []
+            if not values:
+                return table_name, ""
+
+            # Convert to CSV format; csv.writer does the quoting/escaping in C
+            buf = io.StringIO()
+            csv.writer(buf, quoting=csv.QUOTE_MINIMAL, lineterminator="\n").writerows(values)
+            content = buf.getvalue().removesuffix("\n")
+            logger.info(f"Read {len(values)} rows from Google Sheet")
+            return table_name, content
 
         # For CSV and other text files, download directly
         logger.info("Using Google Drive API to download file...")
@@ -256,6 +430,7 @@ class ComposioService:
             data = data["data"]
 
         if data.get("successful") == False:
+            self._invalidate_if_missing(user_id, data.get("error"))
             raise Exception(f"Failed to download file: {data.get('error')}")
 
         # Try different keys where content might be stored
@@ -275,19 +450,19 @@ class ComposioService:
         # Check if content is a file path (Composio saves to disk)
         if content and isinstance(content, str) and content.startswith("/"):
             logger.info(f"Content is a file path: {content}")
-            # It's a file path, read the file with encoding fallback
+            # It's a file path: read the bytes once, then decode with a fallback
             try:
-                with open(content, "r", encoding="utf-8") as f:
-                    content = f.read()
-                logger.info(f"Read {len(content)} bytes from file")
-            except UnicodeDecodeError:
-                # Try latin-1 which can read any byte sequence
+                raw = Path(content).read_bytes()
                 try:
-                    with open(content, "r", encoding="latin-1") as f:
-                        content = f.read()
+                    content = raw.decode("utf-8")
+                    logger.info(f"Read {len(content)} bytes from file")
+                except UnicodeDecodeError:
+                    # latin-1 can decode any byte sequence
+                    content = raw.decode("latin-1")
                     logger.info(f"Read {len(content)} bytes from file (latin-1 encoding)")
-                except Exception as e:
-                    logger.error(f"Failed to read file with fallback encoding: {e}")
+                # Match text-mode reads, which normalize line endings
+                if "\r" in content:
+                    content = content.replace("\r\n", "\n").replace("\r", "\n")
             except Exception as e:
                 logger.error(f"Failed to read file: {e}")
 
@@ -1,9 +1,37 @@
 from google import genai
+from cachetools import LRUCache, TTLCache
+import asyncio
+import hashlib
 import logging
-import time
+import random
+import re
+import threading
 
 logger = logging.getLogger(__name__)
 
+CHAT_MODEL = "gemini-2.0-flash"
+
+# Rows of each CSV sent for schema inference: the header plus this many data rows
+# from the start, and a few from the end to catch type drift further down the file
+SAMPLE_HEAD_ROWS = 50
+SAMPLE_TAIL_ROWS = 10
+
+# Models tried in order for schema inference, each up to SCHEMA_MAX_RETRIES times
+SCHEMA_MODELS = ["gemini-2.0-flash", "gemini-1.5-flash"]
+SCHEMA_MAX_RETRIES = 3
+RATE_LIMITED_MESSAGE = "All Gemini API attempts failed due to rate limiting. Please wait a minute and try again."
+
+# Backoff on 429s: RETRY_BASE_DELAY * 2**attempt seconds plus up to a second of
+# jitter, capped at RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 60
+
+# RetryInfo the API attaches to RESOURCE_EXHAUSTED errors, e.g. 'retryDelay': '31s'
+_RETRY_DELAY_RE = re.compile(r"""retryDelay['"]?\s*:\s*['"]?(\d+(?:\.\d+)?)s""")
+
+# Markdown code fence lines (```sql ... ```) the model sometimes wraps DDL in
+_FENCE_RE = re.compile(r"^```[^\n]*\n?|```\s*$", re.M)
+
 
 class GeminiService:
     def __init__(
@@ -30,13 +58,60 @@ class GeminiService:
         else:
             raise ValueError("Either api_key or (use_vertex_ai + project_id) must be provided")
 
+        # sha256(prompt + model) -> response text, so repeated prompts skip the API
+        self._response_cache: LRUCache = LRUCache(maxsize=2000)
+        self._response_lock = threading.Lock()
+        # sha256(schema prompt) -> DDL, so re-analyzing the same files skips the
+        # model (and its rate limits) entirely
+        self._schema_cache: TTLCache = TTLCache(maxsize=128, ttl=3600)
+        self._schema_lock = threading.Lock()
+
         logger.info("GeminiService initialized successfully")
 
+    def generate_text(self, prompt: str, model: str = CHAT_MODEL) -> str:
+        """Generate a response for a prompt, reusing cached answers for identical prompts."""
+        cache_key = hashlib.sha256((prompt + model).encode()).hexdigest()
+        with self._response_lock:
+            cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached Gemini response")
+            return cached
+
+        response = self.client.models.generate_content(
+            model=model,
+            contents=prompt
+        )
+        with self._response_lock:
+            self._response_cache[cache_key] = response.text
+        return response.text
+
+    def _sample_rows(self, content: str) -> str:
+        """Keep the header, the first SAMPLE_HEAD_ROWS rows and the last SAMPLE_TAIL_ROWS rows."""
+        content = content.rstrip("\n")
+        head = content.split("\n", SAMPLE_HEAD_ROWS + 1)
+        if len(head) <= SAMPLE_HEAD_ROWS + 1:
+            return content
+        tail = head[-1].rsplit("\n", SAMPLE_TAIL_ROWS)
+        if len(tail) <= SAMPLE_TAIL_ROWS:
+            return content
+        return "\n".join(head[:-1] + tail[1:])
+
+    def _retry_wait(self, error: Exception, attempt: int) -> float:
+        """Seconds to wait before retrying a rate-limited call."""
+        # Prefer the delay the API asked for, when it says
+        retry_delay = getattr(error, "retry_delay", None)
+        if retry_delay is None:
+            match = _RETRY_DELAY_RE.search(str(error))
+            retry_delay = float(match.group(1)) if match else None
+        if retry_delay is None:
+            retry_delay = RETRY_BASE_DELAY * 2 ** attempt
+        return min(RETRY_MAX_DELAY, float(retry_delay)) + random.random()
+
     def _build_prompt(self, csv_data: dict[str, str]) -> str:
-        """Build the prompt for Gemini with all CSV data."""
+        """Build the prompt for Gemini with a sample of each CSV."""
         csv_sections = []
         for name, content in csv_data.items():
-            csv_sections.append(f"=== {name}.csv ===\n{content}")
+            csv_sections.append(f"=== {name}.csv ===\n{self._sample_rows(content)}")
 
         all_csvs = "\n\n".join(csv_sections)
 
@@ -67,41 +142,68 @@ Output ONLY valid PostgreSQL DDL. No explanations, just SQL."""
 
     def _clean_ddl(self, ddl: str) -> str:
         """Clean up markdown code blocks if present."""
-        if ddl.startswith("```"):
-            lines = ddl.split("\n")
-            lines = [l for l in lines if not l.startswith("```")]
-            ddl = "\n".join(lines)
-        return ddl.strip()
-
-    def infer_schema(self, csv_data: dict[str, str]) -> str:
-        """Send CSV data to Gemini and get schema inference."""
-        logger.info(f"Building prompt for {len(csv_data)} CSV files...")
-        prompt = self._build_prompt(csv_data)
-        logger.info(f"Prompt length: {len(prompt)} chars")
+        return _FENCE_RE.sub("", ddl).strip()
+
+    async def infer_schema_async(self, csv_data: dict[str, str]) -> str:
+        """
+        Send CSV data to Gemini and get schema inference. Runs on the SDK's async
+        client, so no thread is held while waiting on Gemini.
+        """
+        prompt, cache_key = self._schema_prompt(csv_data)
+        cached = self._cached_schema(cache_key)
+        if cached is not None:
+            return cached
 
         # Try multiple models with retry for rate limits
-        models_to_try = ["gemini-2.0-flash", "gemini-1.5-flash"]
-        max_retries = 3
-
-        for model in models_to_try:
-            for attempt in range(max_retries):
+        for model in SCHEMA_MODELS:
+            for attempt in range(SCHEMA_MAX_RETRIES):
                 logger.info(f"Calling Gemini API (model={model}, attempt {attempt + 1})...")
                 try:
-                    response = self.client.models.generate_content(
+                    response = await self.client.aio.models.generate_content(
                         model=model,
                         contents=prompt
                     )
-                    logger.info("Gemini API call successful!")
-                    logger.info(f"Response length: {len(response.text)} chars")
-                    return self._clean_ddl(response.text)
+                    return self._store_schema(cache_key, response.text)
                 except Exception as e:
-                    error_str = str(e)
-                    if "429" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                        wait_time = (attempt + 1) * 5  # 5, 10, 15 seconds
-                        logger.warning(f"Rate limited, waiting {wait_time}s before retry...")
-                        time.sleep(wait_time)
-                    else:
-                        logger.error(f"Gemini API call failed: {error_str}")
+                    if not self._is_rate_limited(e):
+                        logger.error(f"Gemini API call failed: {str(e)}")
                         raise
+                    wait_time = self._retry_wait(e, attempt)
+                    logger.warning(f"Rate limited, waiting {wait_time:.1f}s before retry...")
+                    await asyncio.sleep(wait_time)
+
+        raise Exception(RATE_LIMITED_MESSAGE)
 
-        raise Exception("All Gemini API attempts failed due to rate limiting. Please wait a minute and try again.")
+    async def infer_schemas_batch(self, csv_data_list: list[dict[str, str]]) -> list[str | BaseException]:
+        """Run several independent schema inferences concurrently. Failures are returned in place."""
+        return await asyncio.gather(
+            *[self.infer_schema_async(csv_data) for csv_data in csv_data_list],
+            return_exceptions=True,
+        )
+
+    def _schema_prompt(self, csv_data: dict[str, str]) -> tuple[str, str]:
+        """Build the schema prompt and its cache key."""
+        logger.info(f"Building prompt for {len(csv_data)} CSV files...")
+        prompt = self._build_prompt(csv_data)
+        logger.info(f"Prompt length: {len(prompt)} chars")
+        return prompt, hashlib.sha256(prompt.encode()).hexdigest()
+
+    def _cached_schema(self, cache_key: str) -> str | None:
+        with self._schema_lock:
+            cached = self._schema_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached schema for identical data")
+        return cached
+
+    def _store_schema(self, cache_key: str, response_text: str) -> str:
+        """Clean and cache a successful schema response."""
+        logger.info("Gemini API call successful!")
+        logger.info(f"Response length: {len(response_text)} chars")
+        ddl = self._clean_ddl(response_text)
+        with self._schema_lock:
+            self._schema_cache[cache_key] = ddl
+        return ddl
+
+    def _is_rate_limited(self, error: Exception) -> bool:
+        error_str = str(error)
+        return "429" in error_str or "RESOURCE_EXHAUSTED" in error_str
@@ -1,202 +1,405 @@
 import re
 import io
+import csv
+import logging
+import threading
+from functools import lru_cache
+from contextlib import contextmanager
+from typing import Iterator
 import psycopg2
+from psycopg2.sql import SQL, Identifier, Literal
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
+# DDL parsing: an identifier is either "quoted" (with "" escapes) or a bare word
+_IDENT = r'"(?:[^"]|"")+"|\w+'
+# A table name, optionally schema-qualified (public.orders); only the last part is captured
+_TABLE = rf'(?:(?:{_IDENT})\s*\.\s*)*({_IDENT})'
+_CREATE_TABLE_RE = re.compile(rf'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?{_TABLE}\s*\(', re.IGNORECASE)
+_FK_CONSTRAINT_RE = re.compile(
+    rf'(?:CONSTRAINT\s+(?:{_IDENT})\s+)?FOREIGN\s+KEY\s*\(([^)]+)\)\s*REFERENCES\s+{_TABLE}\s*\(([^)]+)\)',
+    re.IGNORECASE,
+)
+_CREATE_INDEX_RE = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\b', re.IGNORECASE)
+_CREATE_RE = re.compile(r'CREATE\b', re.IGNORECASE)
+
+
+def _unquote(identifier: str) -> str:
+    """Name Postgres stores for an identifier: quoted names verbatim, bare names lowercased."""
+    identifier = identifier.strip()
+    if identifier.startswith('"') and identifier.endswith('"') and len(identifier) > 1:
+        return identifier[1:-1].replace('""', '"')
+    return identifier.lower()
+
+
+def _split_top_level(sql: str, sep: str) -> list[str]:
+    """
+    Split SQL on sep wherever it isn't inside quotes, parentheses or a comment.
+    Comments are dropped; empty parts are skipped.
+    """
+    parts = []
+    buf = []
+    depth = 0
+    i, n = 0, len(sql)
+    while i < n:
+        ch = sql[i]
+        if ch == "'" or ch == '"':
+            # Copy the quoted run whole; a doubled quote is an escaped quote
+            end = sql.find(ch, i + 1)
+            while end != -1 and sql.startswith(ch, end + 1):
+                end = sql.find(ch, end + 2)
+            end = n if end == -1 else end + 1
+            buf.append(sql[i:end])
+            i = end
+            continue
+        if sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = n if end == -1 else end
+            continue
+        if sql.startswith("/*", i):
+            end = sql.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+            continue
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append("".join(buf).strip())
+            buf = []
+            i += 1
+            continue
+        buf.append(ch)
+        i += 1
+    parts.append("".join(buf).strip())
+    return [part for part in parts if part]
+
+
+@lru_cache(maxsize=32)
+def _parse_ddl(ddl: str) -> tuple[tuple[str, ...], tuple[tuple, ...], tuple[str, ...], tuple[str, ...]]:
+    """
+    Walk the DDL once and return (table_names, fk_constraints, create_statements,
+    index_statements). FOREIGN KEY clauses are pulled out of each CREATE TABLE and
+    CREATE INDEX statements are set aside, so both can be added after the data is
+    loaded; any other statement is ignored, with a warning if it is a CREATE.
+    Schema-qualified table names are reduced to the table's own name; the
+    statement itself runs unchanged.
+    Results are cached, so they are returned as tuples.
+    """
+    tables = []
+    fk_alters = []
+    create_statements = []
+    index_statements = []
+
+    for stmt in _split_top_level(ddl, ";"):
+        if _CREATE_INDEX_RE.match(stmt):
+            index_statements.append(stmt)
+            continue
+        match = _CREATE_TABLE_RE.match(stmt)
+        if not match:
+            if _CREATE_RE.match(stmt):
+                logger.warning("Skipping DDL statement that isn't a CREATE TABLE or CREATE INDEX: %s", stmt)
+            continue
+        table_name = _unquote(match.group(1))
+
+        close = stmt.rfind(")")
+        body, tail = (stmt[match.end():close], stmt[close + 1:]) if close >= match.end() else (stmt[match.end():], "")
+
+        columns = []
+        for element in _split_top_level(body, ","):
+            fk = _FK_CONSTRAINT_RE.match(element)
+            if fk:
+                fk_col, ref_table, ref_col = fk.groups()
+                fk_alters.append((table_name, _unquote(fk_col), _unquote(ref_table), _unquote(ref_col)))
+            else:
+                columns.append(element)
+
+        tables.append(table_name)
+        create_statements.append(f"{stmt[:match.end()]}{', '.join(columns)}){tail}")
+
+    return tuple(tables), tuple(fk_alters), tuple(create_statements), tuple(index_statements)
+
+
+# pandas suffix on repeated CSV header names ("Code", "Code.1")
+_DUPLICATE_SUFFIX_RE = re.compile(r'\.\d+$')
+
 
 class PostgresService:
-    def __init__(self, db_url: str):
+    def __init__(self, db_url: str, min_connections: int = 2, max_connections: int = 10):
         self.db_url = db_url
-
-    def _get_connection(self):
-        """Get a connection to the Postgres database."""
-        return psycopg2.connect(self.db_url)
-
-    def _extract_table_names(self, ddl: str) -> list[str]:
-        """Extract table names from DDL."""
-        pattern = r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)'
-        matches = re.findall(pattern, ddl, re.IGNORECASE)
-        return matches
-
-    def create_tables(self, ddl: str) -> tuple[list[str], list[tuple]]:
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self._pool: ThreadedConnectionPool | None = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool raises instead of waiting when exhausted, so
+        # concurrent callers queue here for a free connection
+        self._slots = threading.BoundedSemaphore(max_connections)
+        # Table name -> column names in order; dropped whenever create_tables rebuilds the table
+        self._columns_cache: dict[str, list[str]] = {}
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        """Create the connection pool on first use."""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadedConnectionPool(
+                        self.min_connections, self.max_connections, self.db_url
+                    )
+        return self._pool
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a pooled connection, rolling back anything left uncommitted."""
+        pool = self._get_pool()
+        with self._slots:
+            conn = pool.getconn()
+            try:
+                yield conn
+            finally:
+                if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+                pool.putconn(conn, close=bool(conn.closed))
+
+    def close(self) -> None:
+        """Close every pooled connection."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def create_tables(self, ddl: str) -> tuple[list[str], list[tuple], list[str]]:
         """Create tables from DDL, dropping existing tables first.
-        Returns (table_names, fk_constraints) - FKs should be added after data insertion.
+        Returns (table_names, fk_constraints, index_statements) - FKs and indexes
+        should be added after data insertion.
         """
-        tables = self._extract_table_names(ddl)
-
-        # Split DDL into individual statements
-        statements = [s.strip() for s in ddl.split(';') if s.strip()]
-
-        # Separate CREATE TABLE statements and extract FK info
-        create_statements = []
-        fk_alters = []
-
-        for stmt in statements:
-            if not re.match(r'CREATE\s+TABLE', stmt, re.IGNORECASE):
-                continue
-
-            # Extract table name
-            table_match = re.search(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[""]?(\w+)[""]?', stmt, re.IGNORECASE)
-            if not table_match:
-                continue
-            table_name = table_match.group(1)
-
-            # Find and extract FOREIGN KEY constraints
-            fk_pattern = r'FOREIGN\s+KEY\s*\(([^)]+)\)\s*REFERENCES\s+[""]?(\w+)[""]?\s*\(([^)]+)\)(?:\s+ON\s+(?:DELETE|UPDATE)\s+(?:CASCADE|SET\s+NULL|NO\s+ACTION|RESTRICT))*'
-            fk_matches = re.findall(fk_pattern, stmt, re.IGNORECASE)
+        tables, fk_alters, create_statements, index_statements = _parse_ddl(ddl)
+        for table in tables:
+            self._columns_cache.pop(table.lower(), None)
 
-            for fk_col, ref_table, ref_col in fk_matches:
-                fk_alters.append((table_name, fk_col.strip().strip('"'), ref_table, ref_col.strip().strip('"')))
-
-            # Remove FK constraints from the CREATE statement line by line
-            lines = stmt.split('\n')
-            clean_lines = []
-            for line in lines:
-                # Skip lines that are FK constraints
-                if re.search(r'^\s*,?\s*FOREIGN\s+KEY', line, re.IGNORECASE):
-                    continue
-                clean_lines.append(line)
-
-            stmt_no_fk = '\n'.join(clean_lines)
-
-            # Clean up trailing commas before )
-            stmt_no_fk = re.sub(r',(\s*)\)', r'\1)', stmt_no_fk)
-
-            # Make sure statement ends with )
-            stmt_no_fk = stmt_no_fk.strip()
-            if not stmt_no_fk.endswith(')'):
-                stmt_no_fk += ')'
-
-            create_statements.append(stmt_no_fk)
-
-        conn = self._get_connection()
-        try:
+        with self._connection() as conn:
             with conn.cursor() as cur:
-                # Drop tables in reverse order (handles FK dependencies)
-                for table in reversed(tables):
-                    cur.execute(f'DROP TABLE IF EXISTS "{table}" CASCADE;')
+                # One round-trip each for the drops and the creates; CASCADE
+                # takes care of FKs between the dropped tables
+                if tables:
+                    cur.execute(SQL("DROP TABLE IF EXISTS {} CASCADE").format(
+                        SQL(", ").join(Identifier(t) for t in reversed(tables))))
 
                 # Create tables without FK constraints
-                for stmt in create_statements:
-                    # Clean up the statement - normalize whitespace
-                    stmt = ' '.join(stmt.split())
-                    print(f"DEBUG executing: {stmt}")
+                if create_statements:
+                    batch = ";\n".join(create_statements) + ";"
+                    logger.debug("executing: %s", batch)
                     try:
-                        cur.execute(stmt + ';')
+                        cur.execute(batch)
                     except Exception as e:
-                        print(f"Error creating table: {e}")
-                        print(f"Statement repr: {repr(stmt)}")
+                        logger.error("Error creating tables: %s", e)
                         raise
 
             conn.commit()
-            return tables, fk_alters
-        finally:
-            conn.close()
+            return list(tables), list(fk_alters), list(index_statements)
+
+    def add_indexes(self, index_statements: list[str]) -> list[str]:
+        """Build secondary indexes after data is inserted. Returns the statements that succeeded."""
+        # One sorted bulk build per index is much cheaper than maintaining it row by row during the load
+        added = []
+        with self._connection() as conn:
+            with conn.cursor() as cur:
+                for stmt in index_statements:
+                    # Savepoints keep one bad index from aborting the rest
+                    cur.execute("SAVEPOINT add_index")
+                    try:
+                        cur.execute(stmt)
+                        cur.execute("RELEASE SAVEPOINT add_index")
+                        added.append(stmt)
+                    except psycopg2.Error as e:
+                        cur.execute("ROLLBACK TO SAVEPOINT add_index")
+                        logger.warning("Could not create index %r: %s", stmt, e)
+            conn.commit()
+            return added
 
     def add_foreign_keys(self, fk_constraints: list[tuple]) -> list[str]:
         """Add foreign key constraints after data is inserted."""
+        # One ALTER per table, so Postgres validates all of a table's new FKs together
+        by_table: dict[str, list[tuple]] = {}
+        for fk in fk_constraints:
+            by_table.setdefault(fk[0], []).append(fk)
+
         added = []
-        conn = self._get_connection()
-        try:
+        with self._connection() as conn:
             with conn.cursor() as cur:
-                for table_name, fk_col, ref_table, ref_col in fk_constraints:
+                for table_name, fks in by_table.items():
+                    # Savepoints keep one bad FK from aborting the whole transaction
+                    cur.execute("SAVEPOINT add_fks")
                     try:
-                        alter_sql = f'ALTER TABLE "{table_name}" ADD FOREIGN KEY ("{fk_col}") REFERENCES "{ref_table}" ("{ref_col}");'
-                        cur.execute(alter_sql)
-                        added.append(f"{table_name}.{fk_col} -> {ref_table}.{ref_col}")
-                    except Exception as e:
-                        print(f"Warning: Could not add FK {table_name}.{fk_col} -> {ref_table}.{ref_col}: {e}")
+                        cur.execute(
+                            f'ALTER TABLE "{table_name}" '
+                            + ", ".join(self._add_fk_clause(fk) for fk in fks)
+                        )
+                        cur.execute("RELEASE SAVEPOINT add_fks")
+                        added.extend(self._describe_fk(fk) for fk in fks)
+                        continue
+                    except psycopg2.Error:
+                        cur.execute("ROLLBACK TO SAVEPOINT add_fks")
+
+                    # Something in the batch failed: add what we can one at a time
+                    for fk in fks:
+                        try:
+                            cur.execute(f'ALTER TABLE "{table_name}" {self._add_fk_clause(fk)}')
+                            cur.execute("RELEASE SAVEPOINT add_fks")
+                            cur.execute("SAVEPOINT add_fks")
+                            added.append(self._describe_fk(fk))
+                        except psycopg2.Error as e:
+                            cur.execute("ROLLBACK TO SAVEPOINT add_fks")
+                            logger.warning("Could not add FK %s: %s", self._describe_fk(fk), e)
+                    cur.execute("RELEASE SAVEPOINT add_fks")
             conn.commit()
             return added
-        finally:
-            conn.close()
+
+    def _add_fk_clause(self, fk: tuple) -> str:
+        _, fk_col, ref_table, ref_col = fk
+        return f'ADD FOREIGN KEY ("{fk_col}") REFERENCES "{ref_table}" ("{ref_col}")'
+
+    def _describe_fk(self, fk: tuple) -> str:
+        table_name, fk_col, ref_table, ref_col = fk
+        return f"{table_name}.{fk_col} -> {ref_table}.{ref_col}"
 
     def insert_csv_data(self, table_name: str, csv_content: str) -> int:
         """Insert CSV data into a table. Returns number of rows inserted."""
-        df = pd.read_csv(io.StringIO(csv_content))
-
-        if df.empty:
+        header = next(csv.reader(io.StringIO(csv_content)), [])
+        if not header:
             return 0
 
-        conn = self._get_connection()
-        try:
+        with self._connection() as conn:
             with conn.cursor() as cur:
+                db_columns = self._table_columns(cur, table_name)
+
+                try:
+                    if len(header) == len(db_columns):
+                        # Columns line up positionally: stream the raw CSV straight into COPY
+                        count = self._copy_csv(cur, table_name, db_columns, io.StringIO(csv_content))
+                    else:
+                        # Map header names onto table columns, then COPY the text
+                        # values as-is so Postgres does the type conversion
+                        df = pd.read_csv(io.StringIO(csv_content), dtype=str)
+                        if df.empty:
+                            return 0
+                        mapped_cols = self._map_columns(df.columns.tolist(), db_columns)
+                        buf = io.StringIO()
+                        df.to_csv(buf, index=False)
+                        buf.seek(0)
+                        count = self._copy_csv(cur, table_name, mapped_cols, buf)
+                    conn.commit()
+                    return count
+                except psycopg2.DataError:
+                    # COPY is stricter than pandas (NA markers, blank lines,
+                    # "3.0" into INTEGER), so retry with typed batched inserts below
+                    conn.rollback()
+
+                df = pd.read_csv(io.StringIO(csv_content))
+
+                if df.empty:
+                    return 0
+
+                mapped_cols = self._map_columns(df.columns.tolist(), db_columns)
 
-                # Get actual column names from the table in order
-                cur.execute(f"""
-                    SELECT column_name FROM information_schema.columns
-                    WHERE table_name = %s
-                    ORDER BY ordinal_position
-                """, (table_name.lower(),))
-                db_columns = [r[0] for r in cur.fetchall()]
-
-                csv_columns = df.columns.tolist()
-
-                # If column counts match, use positional mapping
-                if len(csv_columns) == len(db_columns):
-                    mapped_cols = db_columns
-                else:
-                    # Try to map by name
-                    column_mapping = {}
-                    used_db_cols = set()
-                    for csv_col in csv_columns:
-                        csv_clean = re.sub(r'\.\d+$', '', csv_col).lower().strip()
-                        for db_col in db_columns:
-                            if db_col in used_db_cols:
-                                continue
-                            if db_col.lower() == csv_clean or db_col.lower() == csv_col.lower():
-                                column_mapping[csv_col] = db_col
-                                used_db_cols.add(db_col)
-                                break
-                    mapped_cols = [column_mapping.get(c, c.lower()) for c in csv_columns]
-
-                placeholders = ", ".join(["%s"] * len(mapped_cols))
                 quoted_columns = [f'"{col}"' for col in mapped_cols]
                 column_names = ", ".join(quoted_columns)
-                insert_sql = f'INSERT INTO "{table_name}" ({column_names}) VALUES ({placeholders})'
+                insert_sql = f'INSERT INTO "{table_name}" ({column_names}) VALUES %s'
 
-                for _, row in df.iterrows():
-                    values = [None if pd.isna(v) else v for v in row.tolist()]
-                    cur.execute(insert_sql, values)
+                # NaN -> None for the whole frame at once, then multi-row INSERTs,
+                # 1000 rows per statement
+                rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+                execute_values(cur, insert_sql, rows, page_size=1000)
 
             conn.commit()
             return len(df)
-        finally:
-            conn.close()
+
+    def _table_columns(self, cur, table_name: str) -> list[str]:
+        """Column names of a table in order, looked up once per table."""
+        key = table_name.lower()
+        columns = self._columns_cache.get(key)
+        if columns is None:
+            cur.execute("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_name = %s
+                ORDER BY ordinal_position
+            """, (key,))
+            columns = [r[0] for r in cur.fetchall()]
+            if columns:
+                self._columns_cache[key] = columns
+        return columns
+
+    def _map_columns(self, csv_columns: list[str], db_columns: list[str]) -> list[str]:
+        """Match CSV header names to table columns."""
+        # If column counts match, use positional mapping
+        if len(csv_columns) == len(db_columns):
+            return db_columns
+
+        # Map by name: each table column can be claimed once, in table order,
+        # so "Code" and "Code.1" can't both land on "code"
+        by_name: dict[str, list[str]] = {}
+        for db_col in db_columns:
+            by_name.setdefault(db_col.lower(), []).append(db_col)
+        mapped = []
+        for csv_col in csv_columns:
+            csv_lower = csv_col.lower()
+            csv_clean = _DUPLICATE_SUFFIX_RE.sub('', csv_lower).strip()
+            candidates = by_name.get(csv_clean) or by_name.get(csv_lower)
+            mapped.append(candidates.pop(0) if candidates else csv_lower)
+        return mapped
+
+    def _copy_csv(self, cur, table_name: str, columns: list[str], source) -> int:
+        """COPY a CSV file-like object (with header row) into a table."""
+        column_names = ", ".join(f'"{col}"' for col in columns)
+        cur.copy_expert(
+            f'COPY "{table_name}" ({column_names}) FROM STDIN WITH (FORMAT csv, HEADER true)',
+            source,
+        )
+        return cur.rowcount
 
     def verify_data(self, table_name: str) -> dict:
         """Verify data in a table."""
-        conn = self._get_connection()
-        try:
+        with self._connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(f"SELECT COUNT(*) FROM {table_name}")
-                count = cur.fetchone()[0]
-
-                cur.execute(f"SELECT * FROM {table_name} LIMIT 3")
-                sample = cur.fetchall()
+                # The window count is taken over the whole table before LIMIT
+                # applies, so one round-trip returns both the total and the sample
+                cur.execute(f"SELECT COUNT(*) OVER (), * FROM {table_name} LIMIT 3")
+                rows = cur.fetchall()
 
-                return {"count": count, "sample": sample}
-        finally:
-            conn.close()
+                count = rows[0][0] if rows else 0
+                return {"count": count, "sample": [row[1:] for row in rows]}
 
     def execute_query(self, sql: str) -> tuple[list[str], list[list]]:
         """Execute a SQL query and return columns and rows."""
-        conn = self._get_connection()
-        try:
-            with conn.cursor() as cur:
+        columns, rows = [], []
+        # Pull from a server-side cursor and convert each batch as it arrives, so
+        # the driver never holds a second full copy of the result
+        for columns, batch in self.stream_query(sql, batch_size=10_000):
+            # Convert to list of lists for JSON serialization
+            rows.extend(list(row) for row in batch)
+        return columns, rows
+
+    def stream_query(self, sql: str, batch_size: int = 1000) -> Iterator[tuple[list[str], list[tuple]]]:
+        """
+        Execute a SQL query on a server-side cursor and yield (columns, rows)
+        batches, so the full result set is never held in memory.
+        """
+        with self._connection() as conn:
+            # A named cursor makes Postgres hold the result and hand it out in batches
+            with conn.cursor(name="stream_query") as cur:
                 cur.execute(sql)
-                columns = [desc[0] for desc in cur.description] if cur.description else []
-                rows = cur.fetchall()
-                # Convert to list of lists for JSON serialization
-                rows = [list(row) for row in rows]
-                return columns, rows
-        finally:
-            conn.close()
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    columns = [desc[0] for desc in cur.description] if cur.description else []
+                    yield columns, rows
+                    if len(rows) < batch_size:
+                        break
 
     def list_tables(self) -> list[dict]:
         """List all tables with row counts."""
-        conn = self._get_connection()
-        try:
+        with self._connection() as conn:
             with conn.cursor() as cur:
                 # Get all tables
                 cur.execute("""
@@ -205,12 +408,15 @@ class PostgresService:
                     WHERE table_schema = 'public'
                     ORDER BY table_name
                 """)
-                tables = []
-                for (table_name,) in cur.fetchall():
-                    # Get row count
-                    cur.execute(f'SELECT COUNT(*) FROM "{table_name}"')
-                    count = cur.fetchone()[0]
-                    tables.append({"name": table_name, "row_count": count})
-                return tables
-        finally:
-            conn.close()
+                names = [r[0] for r in cur.fetchall()]
+                if not names:
+                    return []
+
+                # Exact row counts for all of them in one round trip (UNION ALL
+                # branches may come back in any order, so each row carries its name)
+                cur.execute(SQL(" UNION ALL ").join(
+                    SQL("SELECT {}, COUNT(*) FROM {}").format(Literal(name), Identifier(name))
+                    for name in names
+                ))
+                counts = dict(cur.fetchall())
+                return [{"name": name, "row_count": counts[name]} for name in names]
@@ -3,7 +3,9 @@
 Create tables in Postgres from the generated DDL and insert sample data.
 """
 
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import psycopg2
@@ -18,93 +20,86 @@ def get_connection():
     return psycopg2.connect(os.getenv("RENDER_DB_URL"))
 
 
-def drop_tables(conn):
+def drop_tables(cur):
     """Drop existing tables if they exist (in correct order for FK constraints)."""
-    with conn.cursor() as cur:
-        cur.execute("DROP TABLE IF EXISTS orders CASCADE;")
-        cur.execute("DROP TABLE IF EXISTS products CASCADE;")
-        cur.execute("DROP TABLE IF EXISTS customers CASCADE;")
-    conn.commit()
+    cur.execute("DROP TABLE IF EXISTS orders, products, customers CASCADE;")
     print("Dropped existing tables")
 
 
-def create_tables(conn):
+def create_tables(cur):
     """Create tables from the DDL file."""
     ddl = Path("output_schema.sql").read_text()
-
-    with conn.cursor() as cur:
-        cur.execute(ddl)
-    conn.commit()
+    cur.execute(ddl)
     print("Created tables from output_schema.sql")
 
 
-def insert_data(conn):
-    """Insert sample data from CSV files."""
+def copy_rows(cur, table: str, df: pd.DataFrame, columns: list[str]) -> None:
+    """Stream the given DataFrame columns into a table with COPY FROM STDIN."""
+    buf = io.StringIO()
+    df[columns].to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+
+def load_csv(table: str, columns: list[str]) -> int:
+    """Load sample_data/<table>.csv on its own connection and commit it; returns the row count."""
+    # Load as text so values reach Postgres exactly as written; empty cells become NULL
+    df = pd.read_csv(f"sample_data/{table}.csv", dtype=str)
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            # The load is rerunnable from the CSVs, so don't wait on the WAL flush at commit
+            cur.execute("SET LOCAL synchronous_commit = off")
+            copy_rows(cur, table, df, columns)
+        conn.commit()
+    finally:
+        conn.close()
+    return len(df)
 
-    # Load CSVs
-    customers = pd.read_csv("sample_data/customers.csv")
-    products = pd.read_csv("sample_data/products.csv")
-    orders = pd.read_csv("sample_data/orders.csv")
-
-    with conn.cursor() as cur:
-        # Insert customers
-        for _, row in customers.iterrows():
-            cur.execute(
-                """INSERT INTO customers (customer_id, first_name, last_name, email, phone, created_at)
-                   VALUES (%s, %s, %s, %s, %s, %s)""",
-                (row['customer_id'], row['first_name'], row['last_name'],
-                 row['email'], row['phone'], row['created_at'])
-            )
-        print(f"Inserted {len(customers)} customers")
-
-        # Insert products
-        for _, row in products.iterrows():
-            cur.execute(
-                """INSERT INTO products (product_id, product_name, description, price, sku, in_stock)
-                   VALUES (%s, %s, %s, %s, %s, %s)""",
-                (row['product_id'], row['product_name'], row['description'],
-                 row['price'], row['sku'], row['in_stock'])
-            )
-        print(f"Inserted {len(products)} products")
-
-        # Insert orders
-        for _, row in orders.iterrows():
-            cur.execute(
-                """INSERT INTO orders (order_id, customer_id, product_id, quantity, unit_price, total_amount, order_date, status)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
-                (row['order_id'], row['customer_id'], row['product_id'],
-                 row['quantity'], row['unit_price'], row['total_amount'],
-                 row['order_date'], row['status'])
-            )
-        print(f"Inserted {len(orders)} orders")
-
-    conn.commit()
-
-
-def verify_data(conn):
+
+def insert_data():
+    """Insert sample data from CSV files."""
+    # customers and products don't reference each other, so load them side by
+    # side; orders references both and has to wait until they are committed
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        parents = [
+            pool.submit(load_csv, "customers",
+                        ["customer_id", "first_name", "last_name", "email", "phone", "created_at"]),
+            pool.submit(load_csv, "products",
+                        ["product_id", "product_name", "description", "price", "sku", "in_stock"]),
+        ]
+        print(f"Inserted {parents[0].result()} customers")
+        print(f"Inserted {parents[1].result()} products")
+
+    count = load_csv("orders", ["order_id", "customer_id", "product_id", "quantity", "unit_price",
+                                "total_amount", "order_date", "status"])
+    print(f"Inserted {count} orders")
+
+
+def verify_data(cur):
     """Verify the data was inserted correctly."""
-    with conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM customers")
-        print(f"\nVerification:")
-        print(f"  customers: {cur.fetchone()[0]} rows")
-
-        cur.execute("SELECT COUNT(*) FROM products")
-        print(f"  products: {cur.fetchone()[0]} rows")
-
-        cur.execute("SELECT COUNT(*) FROM orders")
-        print(f"  orders: {cur.fetchone()[0]} rows")
-
-        # Test a join to verify FK relationships work
-        cur.execute("""
-            SELECT c.first_name, c.last_name, p.product_name, o.quantity, o.total_amount
-            FROM orders o
-            JOIN customers c ON o.customer_id = c.customer_id
-            JOIN products p ON o.product_id = p.product_id
-            LIMIT 3
-        """)
-        print("\nSample joined data:")
-        for row in cur.fetchall():
-            print(f"  {row[0]} {row[1]} ordered {row[3]}x {row[2]} (${row[4]})")
+    cur.execute("SELECT COUNT(*) FROM customers")
+    print(f"\nVerification:")
+    print(f"  customers: {cur.fetchone()[0]} rows")
+
+    cur.execute("SELECT COUNT(*) FROM products")
+    print(f"  products: {cur.fetchone()[0]} rows")
+
+    cur.execute("SELECT COUNT(*) FROM orders")
+    print(f"  orders: {cur.fetchone()[0]} rows")
+
+    # Test a join to verify FK relationships work
+    cur.execute("""
+        SELECT c.first_name, c.last_name, p.product_name, o.quantity, o.total_amount
+        FROM orders o
+        JOIN customers c ON o.customer_id = c.customer_id
+        JOIN products p ON o.product_id = p.product_id
+        LIMIT 3
+    """)
+    print("\nSample joined data:")
+    for row in cur.fetchall():
+        print(f"  {row[0]} {row[1]} ordered {row[3]}x {row[2]} (${row[4]})")
 
 
 def main():
@@ -116,10 +111,15 @@ def main():
     print("Connected to database")
 
     try:
-        drop_tables(conn)
-        create_tables(conn)
-        insert_data(conn)
-        verify_data(conn)
+        with conn.cursor() as cur:
+            # Drop and recreate in one transaction, so a bad DDL file leaves the
+            # old tables in place; commit before the loads, which use their own connections
+            drop_tables(cur)
+            create_tables(cur)
+            conn.commit()
+
+            insert_data()
+            verify_data(cur)
         print("\nDone!")
     finally:
         conn.close()
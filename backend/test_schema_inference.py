@@ -4,26 +4,38 @@ Test Gemini's ability to infer database schemas from CSV files.
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 
 from google import genai
 from dotenv import load_dotenv
 
+from app.services.gemini import _FENCE_RE
+
 load_dotenv()
 
 # Configure Gemini
 client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
+# Lines read from each CSV (header included); enough for Gemini to infer types
+SAMPLE_LINES = 50
 
-def load_csv_files(data_dir: str = "sample_data") -> dict[str, str]:
-    """Load all CSV files from the data directory."""
-    csv_files = {}
-    data_path = Path(data_dir)
 
-    for csv_file in data_path.glob("*.csv"):
-        csv_files[csv_file.stem] = csv_file.read_text()
+def read_sample(csv_file: Path) -> str:
+    """Read the first SAMPLE_LINES lines of a CSV file."""
+    with open(csv_file) as f:
+        return "".join(islice(f, SAMPLE_LINES))
+
+
+def load_csv_files(data_dir: str = "sample_data") -> dict[str, str]:
+    """Load a sample of every CSV file in the data directory."""
+    paths = sorted(Path(data_dir).glob("*.csv"))
 
-    return csv_files
+    # File reads release the GIL, so a small pool overlaps them
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        samples = pool.map(read_sample, paths)
+        return {path.stem: sample for path, sample in zip(paths, samples)}
 
 
 def build_prompt(csv_data: dict[str, str]) -> str:
@@ -81,11 +93,7 @@ def main():
     ddl = infer_schema()
 
     # Clean up markdown code blocks if present
-    if ddl.startswith("```"):
-        lines = ddl.split("\n")
-        # Remove first line (```sql) and last line (```)
-        lines = [l for l in lines if not l.startswith("```")]
-        ddl = "\n".join(lines)
+    ddl = _FENCE_RE.sub("", ddl)
 
     print("\n" + "=" * 60)
     print("Generated DDL:")